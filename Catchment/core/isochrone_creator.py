@@ -1,31 +1,44 @@
-import json
 import logging
 import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from itertools import groupby
 from operator import itemgetter
-from typing import Dict, List, Optional
+from typing import Deque, Dict, List, Optional, Tuple
 
 import qgis.processing
 from qgis.core import (
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransformContext,
     QgsFeature,
+    QgsFeatureRequest,
+    QgsFeatureSink,
     QgsField,
     QgsFields,
     QgsGeometry,
+    QgsGeometryEngine,
     QgsLayerTreeLayer,
-    QgsPointXY,
+    QgsMultiPolygon,
     QgsProcessing,
+    QgsProcessingContext,
     QgsProject,
+    QgsSpatialIndex,
     QgsTask,
     QgsVectorFileWriter,
     QgsVectorLayer,
     QgsWkbTypes,
 )
+from qgis.PyQt import sip
 from qgis.PyQt.QtCore import QVariant
 from qgis.PyQt.QtNetwork import QNetworkReply
 
+try:
+    # orjson parses the large isochrone responses much faster, if available
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 from ..definitions.constants import Profile, Unit
 from ..qgis_plugin_tools.tools.exceptions import QgsPluginNetworkException
 from ..qgis_plugin_tools.tools.network import fetch
@@ -36,6 +49,18 @@ from ..qgis_plugin_tools.tools.resources import plugin_name
 MAIN_LOGGER = logging.getLogger(plugin_name())
 TASK_LOGGER = logging.getLogger(f"{plugin_name()}_task")
 
+# number of isochrone requests sent to a Graphhopper instance at the same time
+MAX_CONCURRENT_REQUESTS = 8
+# number of points queued for fetching at a time, so that the task can be cancelled
+REQUEST_BATCH_SIZE = 32
+# number of features added to the layer at a time
+FEATURE_BATCH_SIZE = 500
+# minimum time between progress updates in seconds
+PROGRESS_INTERVAL = 0.1
+# number of point and limit polygon pairs above which points are matched to
+# limit polygons with processing instead of the spatial index
+PROCESSING_INTERSECTION_THRESHOLD = 10000
+
 
 @dataclass
 class IsochroneOpts:
@@ -66,6 +91,8 @@ class IsochroneCreator(QgsTask):
         self.opts = opts
         self.error: Optional[Exception] = None
         self.result_layer: Optional[QgsVectorLayer] = None
+        # input point layer in WGS 84
+        self.layer: Optional[QgsVectorLayer] = None
         self.points: list[QgsFeature] = []
         self.limiting_polygons: list[QgsFeature] = []
         # no type checking needed, since we check if options are set
@@ -127,6 +154,9 @@ class IsochroneCreator(QgsTask):
                 polygon_layer = qgis.processing.run(
                     "native:reprojectlayer", alg_params
                 )["OUTPUT"]
+            # All geometries are in WGS 84 from now on, so comparing them never
+            # needs any coordinate transforms inside the feature loops.
+            self.layer = layer
 
             # QgsVectorLayer from main thread may not be used in other threads?
             # How about the QgsFeatures we list here, seems to work fine?
@@ -142,35 +172,55 @@ class IsochroneCreator(QgsTask):
                     name="fids", type=QVariant.String, typeName="varchar"
                 )
                 fields.append(boundary_fid_field)
-                for point in self.points:
+                # Fetch the polygons and build the spatial index once, so that we
+                # only have to check the polygons whose bounding box intersects
+                # each point. The index also stores the geometries, so they can be
+                # used directly with the ids found in the index.
+                polygons: Dict[int, QgsFeature] = {}
+                polygon_index = QgsSpatialIndex(
+                    QgsSpatialIndex.FlagStoreFeatureGeometries
+                )
+                unindexed_count = 0
+                for polygon in polygon_layer.getFeatures():
+                    polygons[polygon.id()] = polygon
+                    if not polygon_index.addFeature(polygon):
+                        unindexed_count += 1
+                if unindexed_count:
+                    MAIN_LOGGER.warning(
+                        f"{unindexed_count} limit polygons have no geometry and"
+                        " could not be added to the spatial index, ignoring them."
+                    )
+                if len(self.points) * len(polygons) > PROCESSING_INTERSECTION_THRESHOLD:
+                    # let processing match all the points at once in C++
+                    point_polygon_ids = self.__match_points_by_processing(
+                        layer, polygon_layer, polygons
+                    )
+                else:
+                    point_polygon_ids = self.__match_points_by_index(polygon_index)
+                for polygon_ids in point_polygon_ids:
                     # - In case a point is located inside multiple polygons, consider
                     #   all of them, i.e. their intersection.
                     # - In case a point has no boundary polygon, do not limit it.
                     boundary_polygon = None
-                    for polygon in polygon_layer.getFeatures():
-                        if point.geometry().intersects(polygon.geometry()):
-                            if not boundary_polygon:
-                                # Here the boundary polygon will get all other fields
-                                # from the *first* polygon. Doesn't matter as long as
-                                # we only save the ids in the end
-                                boundary_polygon = QgsFeature(polygon)
-                                boundary_polygon.setFields(fields)
-                                boundary_polygon["fids"] = str(polygon["fid"])
-                            else:
-                                intersection_parts = (
-                                    boundary_polygon.geometry()
-                                    .intersection(polygon.geometry())
-                                    .asGeometryCollection()
-                                )
-                                intersection_geometry = QgsGeometry.fromMultiPolygonXY(
-                                    [
-                                        geometry.asPolygon()
-                                        for geometry in intersection_parts
-                                        if geometry.wkbType() == QgsWkbTypes.Polygon
-                                    ]
+                    boundary_fids: List[str] = []
+                    for polygon_id in polygon_ids:
+                        polygon = polygons[polygon_id]
+                        if not boundary_polygon:
+                            # Here the boundary polygon will get all other fields
+                            # from the *first* polygon. Doesn't matter as long as
+                            # we only save the ids in the end
+                            boundary_polygon = QgsFeature(polygon)
+                            boundary_polygon.setFields(fields)
+                        else:
+                            intersection_geometry = self.__collect_polygons(
+                                boundary_polygon.geometry().intersection(
+                                    polygon_index.geometry(polygon_id)
                                 )
-                                boundary_polygon.setGeometry(intersection_geometry)
-                                boundary_polygon["fids"] += f",{polygon['fid']}"
+                            )
+                            boundary_polygon.setGeometry(intersection_geometry)
+                        boundary_fids.append(str(polygon["fid"]))
+                    if boundary_polygon:
+                        boundary_polygon["fids"] = ",".join(boundary_fids)
                     self.limiting_polygons.append(boundary_polygon)
             else:
                 # no limiting polygons for any of the points
@@ -271,6 +321,122 @@ class IsochroneCreator(QgsTask):
             root = QgsProject.instance().layerTreeRoot()
             root.insertChildNode(1, QgsLayerTreeLayer(self.result_layer))
 
+    def __match_points_by_index(
+        self, polygon_index: QgsSpatialIndex
+    ) -> List[List[int]]:
+        """Returns the ids of the polygons intersecting each point"""
+        # Prepared polygons are reused by all the points inside them
+        polygon_engines: Dict[int, Tuple[QgsGeometry, QgsGeometryEngine]] = {}
+        point_polygon_ids = []
+        for point in self.points:
+            point_geometry = point.geometry()
+            # The index only returns the polygons whose bounding box intersects
+            # the point, so others are rejected without GEOS. Keep the original
+            # feature order, so that the fids are sorted.
+            candidate_ids = sorted(
+                polygon_index.intersects(point_geometry.boundingBox())
+            )
+            polygon_ids = []
+            for polygon_id in candidate_ids:
+                if polygon_id not in polygon_engines:
+                    polygon_geometry = polygon_index.geometry(polygon_id)
+                    polygon_engines[polygon_id] = (
+                        polygon_geometry,
+                        self.__prepare_geometry(polygon_geometry),
+                    )
+                _, polygon_engine = polygon_engines[polygon_id]
+                if polygon_engine.intersects(point_geometry.constGet()):
+                    polygon_ids.append(polygon_id)
+            point_polygon_ids.append(polygon_ids)
+        return point_polygon_ids
+
+    @staticmethod
+    def __create_indexed_layer(
+        wkb_type: QgsWkbTypes.Type,
+        index_field: str,
+        geometries: Dict[int, QgsGeometry],
+    ) -> QgsVectorLayer:
+        """Returns a memory layer of the geometries, with their keys in index_field"""
+        indexed_layer = QgsVectorLayer(
+            f"{QgsWkbTypes.displayString(wkb_type)}?crs=epsg:4326"
+            f"&field={index_field}:integer",
+            index_field,
+            "memory",
+        )
+        features = []
+        for index, geometry in geometries.items():
+            feature = QgsFeature(indexed_layer.fields())
+            feature.setGeometry(geometry)
+            feature.setAttributes([index])
+            features.append(feature)
+        indexed_layer.dataProvider().addFeatures(features)
+        return indexed_layer
+
+    def __match_points_by_processing(
+        self,
+        layer: QgsVectorLayer,
+        polygon_layer: QgsVectorLayer,
+        polygons: Dict[int, QgsFeature],
+    ) -> List[List[int]]:
+        """Returns the ids of the polygons intersecting each point"""
+        # The intersection result has new feature ids, so the points are copied
+        # with their index in self.points, and the polygons with their feature id.
+        point_layer = self.__create_indexed_layer(
+            layer.wkbType(),
+            "point_index",
+            {index: point.geometry() for index, point in enumerate(self.points)},
+        )
+        overlay_layer = self.__create_indexed_layer(
+            polygon_layer.wkbType(),
+            "polygon_id",
+            {
+                polygon_id: polygon.geometry()
+                for polygon_id, polygon in polygons.items()
+                if polygon.hasGeometry()
+            },
+        )
+        alg_params = {
+            "INPUT": point_layer,
+            "OVERLAY": overlay_layer,
+            "INPUT_FIELDS": ["point_index"],
+            "OVERLAY_FIELDS": ["polygon_id"],
+            "OUTPUT": "memory:",
+        }
+        # Limit polygons are often invalid. The spatial index matching accepts
+        # them, so processing must not stop on them either.
+        context = QgsProcessingContext()
+        context.setInvalidGeometryCheck(QgsFeatureRequest.GeometryNoCheck)
+        intersection_layer = qgis.processing.run(
+            "native:intersection", alg_params, context=context
+        )["OUTPUT"]
+        point_polygon_ids: List[List[int]] = [[] for _ in self.points]
+        for intersection in intersection_layer.getFeatures():
+            point_polygon_ids[intersection["point_index"]].append(
+                intersection["polygon_id"]
+            )
+        # keep the original feature order, so that the fids are sorted
+        return [sorted(polygon_ids) for polygon_ids in point_polygon_ids]
+
+    @staticmethod
+    def __prepare_geometry(geometry: QgsGeometry) -> QgsGeometryEngine:
+        # The engine only refers to the geometry, so the geometry must be kept
+        # alive as long as the engine is in use.
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+        return engine
+
+    @staticmethod
+    def __collect_polygons(geometry: QgsGeometry) -> QgsGeometry:
+        # Only the parts are wrapped in Python, the coordinates stay in C++
+        polygons = [
+            QgsGeometry(part.clone())
+            for part in geometry.constParts()
+            if part.wkbType() == QgsWkbTypes.Polygon
+        ]
+        if not polygons:
+            return QgsGeometry(QgsMultiPolygon())
+        return QgsGeometry.collectGeometry(polygons)
+
     def __add_walking_distance(
         self, isochrone_params: Dict, walking_distance: int
     ) -> Dict:
@@ -278,7 +444,8 @@ class IsochroneCreator(QgsTask):
         # be traversed before reaching the entrance, i.e. the Graphhopper network.
         # This is taken into account to determine the distance to fetch. Note that
         # this will result in very ugly bucket divisions, so this is best used without
-        # buckets.
+        # buckets. The params are modified in place, they are always a copy made for
+        # the current point.
         if not walking_distance:
             return isochrone_params
         if self.opts.unit == Unit.METERS:
@@ -289,7 +456,7 @@ class IsochroneCreator(QgsTask):
                 f"Added walking distance {walking_distance} m. Fetching isochrone"
                 f" for distance {distance} m."
             )
-            return {**isochrone_params, "distance_limit": distance}
+            isochrone_params["distance_limit"] = distance
         elif self.opts.unit == Unit.MINUTES:
             # distance in seconds, walking distance in meters, walking speed 5 km/h
             time = int(
@@ -301,7 +468,8 @@ class IsochroneCreator(QgsTask):
                 f"Added walking time corresponding to {walking_distance} m. Fetching"
                 f" isochrone for time {time} s."
             )
-            return {**isochrone_params, "time_limit": time}
+            isochrone_params["time_limit"] = time
+        return isochrone_params
 
     def __fetch_bucketed_isochrones(self, point_feature: QgsFeature) -> List[Dict]:
         # the API may return multiple isochrones for a single point (buckets)
@@ -309,7 +477,9 @@ class IsochroneCreator(QgsTask):
         isochrones = []
         # the geometry may be multipoint, handle each point
         for point in geometry.parts():
-            isochrone_params = self.params
+            # copy the parameters, since points may be fetched in several threads
+            # and the walking distance modifies them
+            isochrone_params = dict(self.params)
             isochrone_params["point"] = f"{point.y()},{point.x()}"
             if self.opts.add_walking_field:
                 isochrone_params = self.__add_walking_distance(
@@ -327,8 +497,9 @@ class IsochroneCreator(QgsTask):
                         # error content will be empty in older QGIS versions:
                         # https://github.com/qgis/QGIS/issues/42442
                         # In this case, the error message will be the default string.
-                        error_message = json.loads(error_message)["message"]
-                    except json.decoder.JSONDecodeError:
+                        error_message = _json.loads(error_message)["message"]
+                    except ValueError:
+                        # both json and orjson decode errors are ValueErrors
                         pass
                     TASK_LOGGER.warning(
                         f"Request failed for point {point.y()},{point.x()}: {error_message}. "  # noqa
@@ -336,80 +507,167 @@ class IsochroneCreator(QgsTask):
                     return []
                 # All other network exceptions should be raised
                 raise e
-            isochrones.extend(json.loads(isochrone_json)["polygons"])
+            isochrones.extend(_json.loads(isochrone_json)["polygons"])
         return isochrones
 
-    def __add_isochrones_to_layer(self, layer: QgsVectorLayer) -> None:
-        TASK_LOGGER.info("Starting isochrone fetch...")
-        for idx, (point, boundary) in enumerate(
-            zip(self.points, self.limiting_polygons)
-        ):
-            bucketed_isochrones = self.__fetch_bucketed_isochrones(point)
-            for polygon_in_bucket in bucketed_isochrones:
-                feature = QgsFeature(layer.fields())
-                # when merging, we have to discard extra attributes
-                if self.opts.merge_by_field:
-                    attributes = [
-                        point.id(),
-                        point.attribute(self.opts.merge_by_field.name()),
-                    ]
-                else:
-                    attributes = point.attributes()
-                # setAttributes cannot be used, will destroy any extra fields!!
-                for index, attribute in enumerate(attributes):
-                    feature.setAttribute(index, attribute)
-                # set the added distance field separately
-                bucket = polygon_in_bucket["properties"]["bucket"]
-                distance = (bucket + 1) * (
-                    self.opts.distance / self.opts.buckets  # type: ignore
-                )
-                feature["isochrone_distance"] = distance
-
-                isochrone = QgsGeometry.fromMultiPolygonXY(
-                    [
-                        [
-                            [
-                                QgsPointXY(pt[0], pt[1])
-                                for pt in polygon_in_bucket["geometry"]["coordinates"][
-                                    0
-                                ]
-                            ]
-                        ]
-                    ]
+    def __create_point_isochrone_features(
+        self,
+        fields: QgsFields,
+        point: QgsFeature,
+        boundary: Optional[QgsFeature],
+        bucketed_isochrones: List[Dict],
+        boundary_engines: Dict[str, Tuple[QgsGeometry, QgsGeometryEngine]],
+        distance_index: int,
+        boundary_index: int,
+        merge_index: int,
+    ) -> List[QgsFeature]:
+        # when merging, we have to discard extra attributes
+        if self.opts.merge_by_field:
+            point_attributes = [point.id(), point.attribute(merge_index)]
+        else:
+            point_attributes = point.attributes()
+        if boundary:
+            boundary_fids = boundary["fids"]
+            if boundary_fids not in boundary_engines:
+                boundary_geometry = boundary.geometry()
+                boundary_engines[boundary_fids] = (
+                    boundary_geometry,
+                    self.__prepare_geometry(boundary_geometry),
                 )
-                if boundary:
-                    feature["boundary_fids"] = boundary["fids"]
-                    isochrone_parts = (
-                        boundary.geometry()
-                        .intersection(isochrone)
-                        .asGeometryCollection()
-                    )
-                    # After intersecting with the boundary, the isochrone may be a
-                    # GeometryCollection of Polygons, LineStrings and Points. We are
-                    # only interested in 2D areas, so collect all the Polygons to a
-                    # MultiPolygon.
-                    isochrone = QgsGeometry.fromMultiPolygonXY(
-                        [
-                            geometry.asPolygon()
-                            for geometry in isochrone_parts
-                            if geometry.wkbType() == QgsWkbTypes.Polygon
-                        ]
-                    )
-                else:
-                    feature["boundary_fids"] = ""
+            boundary_geometry, boundary_engine = boundary_engines[boundary_fids]
+            boundary_bbox = boundary_geometry.boundingBox()
+        else:
+            boundary_fids = ""
+        # setAttributes would destroy any extra fields if the list was shorter than
+        # the fields, so fill in all the fields. Only the distance differs between
+        # buckets.
+        attributes = [None] * fields.count()
+        attributes[: len(point_attributes)] = point_attributes
+        attributes[boundary_index] = boundary_fids
+
+        features = []
+        for polygon_in_bucket in bucketed_isochrones:
+            feature = QgsFeature(fields)
+            bucket = polygon_in_bucket["properties"]["bucket"]
+            distance = (bucket + 1) * (
+                self.opts.distance / self.opts.buckets  # type: ignore
+            )
+            attributes[distance_index] = distance
+            feature.setAttributes(attributes)
 
-                feature.setGeometry(isochrone)
-                layer.dataProvider().addFeature(feature)
-            if idx and idx % 10 == 0:
-                TASK_LOGGER.info(
-                    f"{idx} out of {len(self.points)} objects fetched"  # type: ignore  # noqa
-                )
-            if self.isCanceled():
-                TASK_LOGGER.warning(
-                    f"Task cancelled, only {idx} out of {len(self.points)} isochrones calculated"  # type: ignore  # noqa
+            # Parsing WKT is done in C++, instead of creating a QgsPointXY per vertex
+            exterior_ring = ", ".join(
+                f"{pt[0]} {pt[1]}"
+                for pt in polygon_in_bucket["geometry"]["coordinates"][0]
+            )
+            isochrone = QgsGeometry.fromWkt(f"MULTIPOLYGON((({exterior_ring})))")
+            # Only intersect with the boundary if the isochrone crosses it
+            if boundary and not boundary_bbox.intersects(isochrone.boundingBox()):
+                isochrone = QgsGeometry(QgsMultiPolygon())
+            elif boundary and not boundary_engine.contains(isochrone.constGet()):
+                # After intersecting with the boundary, the isochrone may be a
+                # GeometryCollection of Polygons, LineStrings and Points. We are
+                # only interested in 2D areas, so collect all the Polygons to a
+                # MultiPolygon.
+                isochrone = self.__collect_polygons(
+                    QgsGeometry(boundary_engine.intersection(isochrone.constGet()))
                 )
-                break
-            self.setProgress(100 * (idx / len(self.points)))
+
+            feature.setGeometry(isochrone)
+            features.append(feature)
+        return features
+
+    def __add_isochrones_to_sink(self, sink: QgsFeatureSink, fields: QgsFields) -> int:
+        """Adds isochrones for all points to the sink and returns their count"""
+        TASK_LOGGER.info("Starting isochrone fetch...")
+        feature_count = 0
+        # Many points may share the same boundary, prepare each boundary only once
+        boundary_engines: Dict[str, Tuple[QgsGeometry, QgsGeometryEngine]] = {}
+        # look up the fields once, instead of by name for every isochrone
+        distance_index = fields.indexOf("isochrone_distance")
+        boundary_index = fields.indexOf("boundary_fids")
+        merge_index = (
+            self.layer.fields().indexOf(self.opts.merge_by_field.name())
+            if self.opts.merge_by_field
+            else -1
+        )
+        # features are added to the sink in batches instead of one by one
+        new_features: List[QgsFeature] = []
+        # log about ten times during the fetch, but not too often for small layers
+        log_interval = max(10, len(self.points) // 10)
+        last_progress_time = time.monotonic()
+        # The requests are network bound, so fetch several points concurrently.
+        # The hosted Graphhopper API (used with an API key) limits the request
+        # rate, so there the requests are sent one at a time.
+        # Only a window of points is queued at a time, so that cancelling the task
+        # does not have to wait for the whole layer to be fetched. The next point
+        # is queued whenever a result is used, so the workers never run dry.
+        max_workers = 1 if self.opts.api_key else MAX_CONCURRENT_REQUESTS
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures: Deque[Future] = deque(
+                executor.submit(self.__fetch_bucketed_isochrones, queued_point)
+                for queued_point in self.points[:REQUEST_BATCH_SIZE]
+            )
+            try:
+                for idx, (point, boundary) in enumerate(
+                    zip(self.points, self.limiting_polygons)
+                ):
+                    future = futures.popleft()
+                    if idx + REQUEST_BATCH_SIZE < len(self.points):
+                        futures.append(
+                            executor.submit(
+                                self.__fetch_bucketed_isochrones,
+                                self.points[idx + REQUEST_BATCH_SIZE],
+                            )
+                        )
+                    bucketed_isochrones = future.result()
+                    new_features.extend(
+                        self.__create_point_isochrone_features(
+                            fields,
+                            point,
+                            boundary,
+                            bucketed_isochrones,
+                            boundary_engines,
+                            distance_index,
+                            boundary_index,
+                            merge_index,
+                        )
+                    )
+                    if len(new_features) >= FEATURE_BATCH_SIZE:
+                        if not sink.addFeatures(new_features):
+                            # e.g. the disk is full, the rest would fail as well
+                            TASK_LOGGER.error("Could not add isochrones, aborting")
+                            new_features = []
+                            break
+                        feature_count += len(new_features)
+                        new_features = []
+                    if idx and idx % log_interval == 0:
+                        TASK_LOGGER.info(
+                            f"{idx} out of {len(self.points)} objects fetched"  # type: ignore  # noqa
+                        )
+                    if self.isCanceled():
+                        TASK_LOGGER.warning(
+                            f"Task cancelled, only {idx} out of {len(self.points)} isochrones calculated"  # type: ignore  # noqa
+                        )
+                        break
+                    # progress is signalled to the main thread, so throttle the updates
+                    now = time.monotonic()
+                    if (
+                        now - last_progress_time >= PROGRESS_INTERVAL
+                        or idx == len(self.points) - 1
+                    ):
+                        self.setProgress(100 * (idx / len(self.points)))
+                        last_progress_time = now
+            finally:
+                # In case the task was cancelled or a request failed, do not wait
+                # for the rest of the window. Requests already running cannot be
+                # cancelled, this only cancels the ones still waiting.
+                for future in futures:
+                    future.cancel()
+        if not sink.addFeatures(new_features):
+            TASK_LOGGER.error("Could not add isochrones")
+            return feature_count
+        return feature_count + len(new_features)
 
     def __merge_isochrones_in_layer(self, layer: QgsVectorLayer) -> None:
         field_name = self.opts.merge_by_field.name()
@@ -422,30 +680,36 @@ class IsochroneCreator(QgsTask):
             layer.dataProvider().fieldNameIndex(field_name),
             layer.dataProvider().fieldNameIndex("isochrone_distance"),
         )
-        sorted_features = sorted(layer.getFeatures(), key=merge_criterion)
-        grouped_features = groupby(sorted_features, key=merge_criterion)
+        original_fid_index = layer.fields().indexOf("original_fid")
+        boundary_index = layer.fields().indexOf("boundary_fids")
+        # group in a single pass, no need to sort the features first
+        grouped_features: Dict[Tuple, List[QgsFeature]] = {}
+        for feature in layer.getFeatures():
+            grouped_features.setdefault(merge_criterion(feature), []).append(feature)
         merged_features = []
-        for group in grouped_features:
+        for (field_value, distance_value), group in grouped_features.items():
             merged_feature = QgsFeature(layer.fields())
-            merged_geometry = None
+            if len(group) == 1:
+                # nothing to merge, e.g. buildings with only one entrance
+                merged_geometry = group[0].geometry()
+            else:
+                # union all the geometries at once, much faster than combining them
+                # one by one
+                merged_geometry = QgsGeometry.unaryUnion(
+                    [feature.geometry() for feature in group]
+                )
+            # now, the result may be polygon *or* multipolygon
+            if merged_geometry.wkbType() == QgsWkbTypes.Polygon:
+                merged_geometry.convertToMultiType()
             merged_ids = set()
             merged_boundary_ids = set()
-            for feature in group[1]:
-                if not merged_geometry:
-                    merged_geometry = feature.geometry()
-                else:
-                    merged_geometry = merged_geometry.combine(feature.geometry())
-                    # now, the result may be polygon *or* multipolygon
-                    if merged_geometry.wkbType() == QgsWkbTypes.Polygon:
-                        merged_geometry = QgsGeometry.fromMultiPolygonXY(
-                            [merged_geometry.asPolygon()]
-                        )
-                merged_ids.add(feature["original_fid"])
+            for feature in group:
+                merged_ids.add(feature.attribute(original_fid_index))
                 # boundary fids may be the same, only save different boundary ids
-                merged_boundary_ids.update(feature["boundary_fids"].split(","))
+                boundary_fids = feature.attribute(boundary_index)
+                if boundary_fids:
+                    merged_boundary_ids.update(boundary_fids.split(","))
 
-            field_value = group[0][0]
-            distance_value = group[0][1]
             # finally, sort the ids
             merged_ids = sorted(list(merged_ids))
             merged_boundary_ids = sorted(list(merged_boundary_ids))
@@ -460,13 +724,7 @@ class IsochroneCreator(QgsTask):
         layer.dataProvider().truncate()
         layer.dataProvider().addFeatures(merged_features)
 
-    def create_isochrone_layer(self) -> QgsVectorLayer:
-        """Creates a polygon QgsVectorLayer containing isochrones for points"""
-        isochrone_layer = QgsVectorLayer(
-            "Polygon?crs=epsg:4326&index=yes", self.name, "memory"
-        )
-
-        # add all the required fields to the new layer
+    def __create_isochrone_fields(self) -> QgsFields:
         fields = QgsFields()
         # save original fid(s) as string to support multiple point ids
         original_fid_field = QgsField(
@@ -482,7 +740,7 @@ class IsochroneCreator(QgsTask):
             # We must make a copy of original fields, then edit it, then iterate it
             # to get the desired final field ordering. Yeah, fields can only be
             # added to the end, go figure.
-            original_fields = QgsFields(self.opts.layer.fields())  # type: ignore
+            original_fields = QgsFields(self.layer.fields())  # type: ignore
             # remove the fid field
             original_fields.remove(0)
             for field in original_fields:
@@ -497,39 +755,136 @@ class IsochroneCreator(QgsTask):
         )
         fields.append(distance_field)
         fields.append(boundary_fid_field)
-        provider = isochrone_layer.dataProvider()
-        provider.addAttributes(fields)
+        return fields
+
+    def __create_memory_layer(self, fields: QgsFields) -> QgsVectorLayer:
+        isochrone_layer = QgsVectorLayer(
+            "Polygon?crs=epsg:4326&index=yes", self.name, "memory"
+        )
+        isochrone_layer.dataProvider().addAttributes(fields)
         isochrone_layer.updateFields()
+        return isochrone_layer
 
-        self.__add_isochrones_to_layer(isochrone_layer)
+    def __write_isochrones_to_memory(self, fields: QgsFields) -> QgsVectorLayer:
+        isochrone_layer = self.__create_memory_layer(fields)
+        self.__add_isochrones_to_sink(isochrone_layer.dataProvider(), fields)
         if self.opts.merge_by_field:
             self.__merge_isochrones_in_layer(isochrone_layer)
         # update layer's extent when new features have been added
         isochrone_layer.updateExtents()
+        return isochrone_layer
+
+    @staticmethod
+    def __remove_file(file_name: str) -> None:
+        # Only log failures, so that they do not hide the error that caused the
+        # file to be removed in the first place.
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            TASK_LOGGER.warning(f"Could not remove file {file_name}: {e}")
+
+    def __write_isochrones_to_file(
+        self, fields: QgsFields, geopackage_file: str
+    ) -> QgsVectorLayer:
+        # Write to a temporary file first, so that an earlier file with the same
+        # name is only replaced if the isochrones were written successfully.
+        temporary_file = f"{os.path.splitext(geopackage_file)[0]}.tmp.gpkg"
+        save_options = QgsVectorFileWriter.SaveVectorOptions()
+        # the layer would be named after the temporary file otherwise
+        save_options.layerName = self.name
+        writer = QgsVectorFileWriter.create(
+            temporary_file,
+            fields,
+            QgsWkbTypes.MultiPolygon,
+            QgsCoordinateReferenceSystem("EPSG:4326"),
+            QgsCoordinateTransformContext(),
+            save_options,
+        )
+        if writer.hasError():
+            TASK_LOGGER.error(
+                f"Could not save file: {writer.errorMessage()}",
+            )
+            sip.delete(writer)
+            self.__remove_file(temporary_file)
+            return self.__write_isochrones_to_memory(fields)
+
+        feature_count = 0
+        write_error = ""
+        try:
+            feature_count = self.__add_isochrones_to_sink(writer, fields)
+            if writer.hasError():
+                write_error = writer.errorMessage()
+        finally:
+            # Close the file explicitly. If the fetch failed, the traceback still
+            # refers to the writer, so deleting our reference would not close it.
+            sip.delete(writer)
+            if not feature_count or write_error:
+                # do not leave empty or partial files behind
+                self.__remove_file(temporary_file)
+        if write_error:
+            TASK_LOGGER.error(f"Could not save file: {write_error}")
+            # the file is incomplete, fetch into memory like when it cannot be created
+            return self.__write_isochrones_to_memory(fields)
+        if not feature_count:
+            return self.__create_memory_layer(fields)
+        try:
+            os.replace(temporary_file, geopackage_file)
+        except OSError as e:
+            # e.g. the file from an earlier run is still open in the project
+            TASK_LOGGER.error(f"Could not save file: {e}")
+            # like when saving fails otherwise, return the isochrones in memory
+            file_layer = QgsVectorLayer(temporary_file, self.name, "ogr")
+            isochrone_layer = file_layer.materialize(QgsFeatureRequest())
+            # the temporary file has to be closed before it can be removed
+            sip.delete(file_layer)
+            self.__remove_file(temporary_file)
+            return isochrone_layer
+        TASK_LOGGER.info(f"Saved to file {geopackage_file}")
+        return QgsVectorLayer(geopackage_file, self.name, "ogr")
+
+    def __save_layer_to_file(
+        self, isochrone_layer: QgsVectorLayer, geopackage_file: str
+    ) -> QgsVectorLayer:
+        save_options = QgsVectorFileWriter.SaveVectorOptions()
+        # merged isochrones are multipolygons, same as the streamed isochrones
+        save_options.overrideGeometryType = QgsWkbTypes.MultiPolygon
+        error = QgsVectorFileWriter.writeAsVectorFormatV2(
+            isochrone_layer,
+            geopackage_file,
+            QgsCoordinateTransformContext(),
+            save_options,
+        )
+        if error[0]:
+            TASK_LOGGER.error(
+                f"Could not save file: {error}",
+            )
+            return isochrone_layer
+        # in case the layer was saved, return the saved layer instead
+        TASK_LOGGER.info(f"Saved to file {geopackage_file}")
+        return QgsVectorLayer(geopackage_file, self.name, "ogr")
+
+    def create_isochrone_layer(self) -> QgsVectorLayer:
+        """Creates a polygon QgsVectorLayer containing isochrones for points"""
+        fields = self.__create_isochrone_fields()
 
         # in case a directory was specified, save the layer to geopackage
         geopackage_file = None
-        if (
-            isochrone_layer.featureCount()
-            and self.opts.write_to_directory
-            and self.opts.directory
-        ):
+        if self.opts.write_to_directory and self.opts.directory:
             geopackage_file = os.path.join(self.opts.directory, f"{self.name}.gpkg")
-            save_options = QgsVectorFileWriter.SaveVectorOptions()
-            error = QgsVectorFileWriter.writeAsVectorFormatV2(
-                isochrone_layer,
-                geopackage_file,
-                QgsCoordinateTransformContext(),
-                save_options,
-            )
-            if error[0]:
-                TASK_LOGGER.error(
-                    f"Could not save file: {error}",
+
+        if geopackage_file and not self.opts.merge_by_field:
+            # Isochrones can be written straight to the file, without keeping
+            # them all in memory first. Merging needs all the isochrones, so then
+            # they are saved only after merging.
+            isochrone_layer = self.__write_isochrones_to_file(fields, geopackage_file)
+        else:
+            isochrone_layer = self.__write_isochrones_to_memory(fields)
+            if isochrone_layer.featureCount() and geopackage_file:
+                isochrone_layer = self.__save_layer_to_file(
+                    isochrone_layer, geopackage_file
                 )
-            else:
-                # in case the layer was saved, return the saved layer instead
-                TASK_LOGGER.info(f"Saved to file {geopackage_file}")
-                isochrone_layer = QgsVectorLayer(geopackage_file, self.name, "ogr")
 
         isochrone_layer.renderer().symbol().setOpacity(0.15)
         return isochrone_layer